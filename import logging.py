@@ -1,7 +1,12 @@
 import logging
 import sqlite3
 import os
+import threading
+import time
+import itertools
 import jdatetime # For Shamsi date
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
 from datetime import datetime
 import asyncio # For potential sleeps if needed
 
@@ -12,7 +17,7 @@ from telegram.ext import (
     CallbackQueryHandler,
     ContextTypes,
     PersistenceInput, # For user_data persistence (optional but good)
-    DictPersistence,  # Simple dictionary-based persistence
+    PicklePersistence, # File-backed persistence for user_data
 )
 from telegram.constants import ParseMode
 from telegram.error import BadRequest, Forbidden # Specific Telegram errors
@@ -24,13 +29,24 @@ LOG_FILE = "telegram_bot.log"
 UPDATE_INTERVAL_SECONDS = 60 # Send updates every 60 seconds
 
 # --- Logging Setup ---
+# Records go onto an in-process queue and a background QueueListener drains
+# them to the file and console, so a logger.info on the event-loop thread
+# costs a queue.put instead of a blocking file write.
+_log_queue = Queue(-1)
+_log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_file_handler = logging.FileHandler(LOG_FILE)
+_file_handler.setFormatter(_log_formatter)
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(_log_formatter)
+_log_listener = QueueListener(_log_queue, _file_handler, _stream_handler)
+_log_listener.start()
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler()
-    ])
+    # Plain passthrough: QueueHandler.prepare() bakes this format into the
+    # record, so the real formatting must happen only in the listener's
+    # handlers or every line gets formatted twice.
+    format='%(message)s',
+    handlers=[QueueHandler(_log_queue)])
 logger = logging.getLogger(__name__)
 
 # --- Callback Data Constants ---
@@ -38,32 +54,49 @@ CALLBACK_DONE = "DONE_SELECT"
 CALLBACK_PREFIX_TOGGLE = "TOGGLE_"
 
 # --- Database Setup & Helpers ---
+# Shared connection, opened once in setup_database(). Reopening per query
+# throws away SQLite's per-connection page cache and pays file open/close
+# on every call. PTB runs jobs/handlers on different threads, so the
+# connection is created with check_same_thread=False and every access is
+# serialized through _DB_LOCK.
+_CONN: sqlite3.Connection | None = None
+_DB_LOCK = threading.Lock()
+
 def setup_database():
-    """Creates user-related tables if they don't exist."""
+    """Creates user-related tables and opens the shared connection."""
+    global _CONN
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            # Users table: Basic user info + last message ID for updates
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                chat_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                last_message_id INTEGER
-            )""")
-            # Subscriptions table: Links users to the price captions they follow
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                chat_id INTEGER NOT NULL,
-                caption TEXT NOT NULL,
-                FOREIGN KEY (chat_id) REFERENCES users(chat_id),
-                PRIMARY KEY (chat_id, caption)
-            )""")
-            # Optional: Index for faster lookups if needed later
-            # cursor.execute("CREATE INDEX IF NOT EXISTS idx_sub_chat_id ON subscriptions (chat_id)")
-            conn.commit()
-            logger.info("User database setup complete.")
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+        cursor = conn.cursor()
+        # WAL lets the miner write while the bot reads; the remaining
+        # PRAGMAs keep temp data and a generous page cache (64MB) in memory.
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA cache_size=-64000")
+        # Required for ON DELETE CASCADE below; off by default in sqlite3.
+        cursor.execute("PRAGMA foreign_keys=ON")
+        # Users table: Basic user info + last message ID for updates
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            chat_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            last_message_id INTEGER
+        )""")
+        # Subscriptions table: Links users to the price captions they follow
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            chat_id INTEGER NOT NULL,
+            caption TEXT NOT NULL,
+            FOREIGN KEY (chat_id) REFERENCES users(chat_id) ON DELETE CASCADE,
+            PRIMARY KEY (chat_id, caption)
+        )""")
+        # Optional: Index for faster lookups if needed later
+        # cursor.execute("CREATE INDEX IF NOT EXISTS idx_sub_chat_id ON subscriptions (chat_id)")
+        _CONN = conn
+        logger.info("User database setup complete.")
     except sqlite3.Error as e:
         logger.error(f"User database setup error: {e}")
         raise
@@ -71,11 +104,11 @@ def setup_database():
 def db_query(query, params=(), fetchone=False, commit=False):
     """General purpose DB query helper to reduce boilerplate."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute(query, params)
+        with _DB_LOCK:
+            cursor = _CONN.execute(query, params)
             if commit:
-                conn.commit()
+                # Connection is in autocommit mode (isolation_level=None),
+                # so the write is already durable at this point.
                 return None # Or return affected rows if needed
             else:
                 return cursor.fetchone() if fetchone else cursor.fetchall()
@@ -84,6 +117,14 @@ def db_query(query, params=(), fetchone=False, commit=False):
         # Depending on severity, you might want to return None or raise
         return None if fetchone else [] # Return empty list/None on error for reads
 
+async def adb_query(*args, **kwargs):
+    """Async wrapper for db_query: runs the blocking sqlite call in a thread.
+
+    Keeps the event loop free to service other updates while SQLite I/O is
+    in flight; _DB_LOCK still serializes access to the shared connection.
+    """
+    return await asyncio.to_thread(db_query, *args, **kwargs)
+
 # --- User & Subscription Management ---
 async def register_user(chat_id: int, username: str, first_name: str, last_name: str):
     """Adds or ignores a user in the users table."""
@@ -91,7 +132,7 @@ async def register_user(chat_id: int, username: str, first_name: str, last_name:
     INSERT OR IGNORE INTO users (chat_id, username, first_name, last_name, last_message_id)
     VALUES (?, ?, ?, ?, NULL)
     """
-    db_query(query, (chat_id, username, first_name, last_name), commit=True)
+    await adb_query(query, (chat_id, username, first_name, last_name), commit=True)
     logger.info(f"Registered/Verified user: {chat_id} ({username or 'No username'})")
 
 def get_user_subscriptions(chat_id: int) -> list[str]:
@@ -100,13 +141,27 @@ def get_user_subscriptions(chat_id: int) -> list[str]:
     results = db_query(query, (chat_id,))
     return [row[0] for row in results]
 
+# The set of available items only changes when the miner runs (once per
+# minute), yet get_available_items() is hit on every keyboard button press.
+# A short TTL cache keeps those clicks out of SQLite entirely.
+_AVAIL_CACHE = {"t": 0.0, "v": []}
+_AVAIL_CACHE_TTL = 30.0 # seconds
+
 def get_available_items() -> list[str]:
-    """Gets distinct available price captions from the database."""
-    query = "SELECT DISTINCT caption FROM prices ORDER BY caption"
+    """Gets available price captions from the database (cached briefly)."""
+    if _AVAIL_CACHE["v"] and time.monotonic() - _AVAIL_CACHE["t"] < _AVAIL_CACHE_TTL:
+        return _AVAIL_CACHE["v"]
+
+    # caption is the PRIMARY KEY of prices, so the B-tree already yields
+    # unique captions in sorted order - no DISTINCT needed.
+    query = "SELECT caption FROM prices ORDER BY caption"
     results = db_query(query)
     if not results:
         logger.warning("No price items found in the database. Miner might not be running.")
-    return [row[0] for row in results]
+    items = [row[0] for row in results]
+    _AVAIL_CACHE["t"] = time.monotonic()
+    _AVAIL_CACHE["v"] = items
+    return items
 
 def update_user_subscriptions(chat_id: int, captions: list[str]):
     """Updates a user's subscriptions atomically."""
@@ -114,10 +169,11 @@ def update_user_subscriptions(chat_id: int, captions: list[str]):
     insert_query = "INSERT INTO subscriptions (chat_id, caption) VALUES (?, ?)"
 
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            # Start transaction
-            cursor.execute("BEGIN TRANSACTION")
+        with _DB_LOCK:
+            cursor = _CONN.cursor()
+            # Start transaction; IMMEDIATE takes the write lock up front
+            # instead of upgrading from a read lock at the first INSERT.
+            cursor.execute("BEGIN IMMEDIATE")
             # Delete old subscriptions
             cursor.execute(delete_query, (chat_id,))
             # Insert new ones
@@ -129,7 +185,7 @@ def update_user_subscriptions(chat_id: int, captions: list[str]):
     except sqlite3.Error as e:
         logger.error(f"Database error updating subscriptions for {chat_id}: {e}")
         try:
-             conn.execute("ROLLBACK") # Rollback on error
+             _CONN.execute("ROLLBACK") # Rollback on error
         except: pass # Ignore rollback errors
 
 # --- Telegram Command Handlers ---
@@ -145,10 +201,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     first_name = user.first_name
     last_name = user.last_name
 
-    await register_user(chat_id, username, first_name, last_name)
+    # Registration doesn't affect keyboard rendering, so don't make the user
+    # wait on the DB write - fire it off and render the keyboard right away.
+    asyncio.create_task(register_user(chat_id, username, first_name, last_name))
 
     # Initialize or clear temporary selection state in user_data
-    context.user_data['temp_selection'] = set(get_user_subscriptions(chat_id)) # Pre-load current subs
+    current_subs = await asyncio.to_thread(get_user_subscriptions, chat_id)
+    context.user_data['temp_selection'] = set(current_subs) # Pre-load current subs
 
     await send_item_selection_keyboard(chat_id, context, "سلام! لطفا موارد مورد نظر برای دریافت قیمت را انتخاب کنید:")
 
@@ -164,7 +223,8 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
 
     # Ensure temporary selection exists
     if 'temp_selection' not in context.user_data:
-        context.user_data['temp_selection'] = set(get_user_subscriptions(chat_id)) # Initialize if missing
+        current_subs = await asyncio.to_thread(get_user_subscriptions, chat_id)
+        context.user_data['temp_selection'] = set(current_subs) # Initialize if missing
 
 
     if callback_data == CALLBACK_DONE:
@@ -172,8 +232,9 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         final_selection_set = context.user_data.get('temp_selection', set())
         final_selection_list = sorted(list(final_selection_set)) # Save sorted list
 
-        update_user_subscriptions(chat_id, final_selection_list)
+        await asyncio.to_thread(update_user_subscriptions, chat_id, final_selection_list)
         del context.user_data['temp_selection'] # Clean up temp data
+        context.user_data.pop('keyboard', None)
 
         confirmation_text = "✅ تنظیمات شما ذخیره شد.\n قیمت موارد زیر برای شما ارسال خواهد شد:\n\n"
         if final_selection_list:
@@ -205,38 +266,75 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
 
         context.user_data['temp_selection'] = temp_selection_set # Save updated set
 
-        # Update the keyboard message
-        await edit_selection_keyboard(chat_id, message_id, context, "لطفا موارد مورد نظر را انتخاب کنید:")
+        # Update the keyboard in place: rebuild only the toggled button,
+        # reuse the rest, and edit just the reply markup. The smaller
+        # payload also lets Telegram's not-modified check short-circuit.
+        keyboard_rows = context.user_data.get('keyboard')
+        if keyboard_rows:
+            is_selected = item_caption in temp_selection_set
+            new_text = ("✅ " if is_selected else "") + item_caption
+            for row in keyboard_rows:
+                for i, button in enumerate(row):
+                    if button.callback_data == callback_data:
+                        # Buttons are immutable, so swap in a fresh one
+                        row[i] = InlineKeyboardButton(new_text, callback_data=callback_data)
+                        break
+                else:
+                    continue
+                break
+            try:
+                await context.bot.edit_message_reply_markup(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    reply_markup=InlineKeyboardMarkup(keyboard_rows)
+                )
+            except BadRequest as e:
+                if "Message is not modified" not in str(e):
+                    logger.warning(f"Failed to edit reply markup for {chat_id}: {e}")
+        else:
+            # No cached keyboard (e.g. cold start) - fall back to full rebuild
+            await edit_selection_keyboard(chat_id, message_id, context, "لطفا موارد مورد نظر را انتخاب کنید:")
 
 # --- Keyboard Generation & Sending ---
+# The keyboard's shape (items, row chunking, callback_data strings) only
+# changes when the available-items cache refreshes; per user only the "✅ "
+# prefix differs. Cache the chunked (item, callback_data) pairs keyed on
+# the list object get_available_items() returned, so this invalidates in
+# lockstep with the 30s TTL above.
+_KB_CACHE = {"items": None, "rows": []}
+ITEMS_PER_ROW = 2
+
+def _base_keyboard_rows(available_items: list[str]) -> list[list[tuple[str, str]]]:
+    """Returns the row-chunked (item, callback_data) pairs for the keyboard."""
+    if _KB_CACHE["items"] is not available_items:
+        pairs = [(item, CALLBACK_PREFIX_TOGGLE + item) for item in available_items]
+        _KB_CACHE["rows"] = [pairs[i:i + ITEMS_PER_ROW]
+                             for i in range(0, len(pairs), ITEMS_PER_ROW)]
+        _KB_CACHE["items"] = available_items
+    return _KB_CACHE["rows"]
+
 def build_selection_keyboard(available_items: list[str], selected_items: set[str]) -> InlineKeyboardMarkup:
     """Builds the dynamic inline keyboard for item selection."""
-    keyboard = []
-    row = []
-    items_per_row = 2
-
-    for item in available_items:
-        is_selected = item in selected_items
-        button_text = ("✅ " if is_selected else "") + item
-        row.append(InlineKeyboardButton(button_text, callback_data=CALLBACK_PREFIX_TOGGLE + item))
-        if len(row) >= items_per_row:
-            keyboard.append(row)
-            row = []
-    if row:
-        keyboard.append(row)
-
+    keyboard = [
+        [InlineKeyboardButton(("✅ " if item in selected_items else "") + item,
+                              callback_data=callback_data)
+         for item, callback_data in base_row]
+        for base_row in _base_keyboard_rows(available_items)
+    ]
     keyboard.append([InlineKeyboardButton("✅ ذخیره و پایان", callback_data=CALLBACK_DONE)])
     return InlineKeyboardMarkup(keyboard)
 
 async def send_item_selection_keyboard(chat_id: int, context: ContextTypes.DEFAULT_TYPE, text: str):
     """Sends the initial selection keyboard message."""
-    available_items = get_available_items()
+    available_items = await asyncio.to_thread(get_available_items)
     if not available_items:
         await context.bot.send_message(chat_id, "متاسفانه در حال حاضر لیستی برای انتخاب وجود ندارد. لطفا بعدا دوباره /start را بزنید.")
         return
 
     selected_items_set = context.user_data.get('temp_selection', set())
     reply_markup = build_selection_keyboard(available_items, selected_items_set)
+    # Cache the rows so toggles can patch one button instead of rebuilding
+    context.user_data['keyboard'] = [list(row) for row in reply_markup.inline_keyboard]
 
     await context.bot.send_message(
         chat_id=chat_id,
@@ -247,9 +345,10 @@ async def send_item_selection_keyboard(chat_id: int, context: ContextTypes.DEFAU
 
 async def edit_selection_keyboard(chat_id: int, message_id: int, context: ContextTypes.DEFAULT_TYPE, text: str):
     """Edits the keyboard message during selection."""
-    available_items = get_available_items() # Might need to refresh if items change? Unlikely mid-selection.
+    available_items = await asyncio.to_thread(get_available_items) # Might need to refresh if items change? Unlikely mid-selection.
     selected_items_set = context.user_data.get('temp_selection', set())
     reply_markup = build_selection_keyboard(available_items, selected_items_set)
+    context.user_data['keyboard'] = [list(row) for row in reply_markup.inline_keyboard]
 
     try:
         await context.bot.edit_message_text( # Edit text too, in case instructions change
@@ -265,88 +364,86 @@ async def edit_selection_keyboard(chat_id: int, message_id: int, context: Contex
             logger.warning(f"Failed to edit selection keyboard for {chat_id}: {e}")
 
 # --- Price Update Sending Job ---
+# The Shamsi date only changes once a day, so cache the formatted string per
+# Gregorian date instead of redoing the jdatetime conversion every job tick.
+_SHAMSI_CACHE = {"day": None, "s": "N/A"}
+
 def get_shamsi_date() -> str:
-    """Gets the current Shamsi date."""
-    try:
-        # Use jdatetime library
-        now_gregorian = datetime.now()
-        now_shamsi = jdatetime.datetime.fromgregorian(datetime=now_gregorian)
-        # Format: YYYY/MM/DD (adjust as needed)
-        return now_shamsi.strftime("%Y/%m/%d")
-        # Alternative: Call the keybit API if preferred
-        # response = requests.get("https://api.keybit.ir/time/")
-        # response.raise_for_status()
-        # return response.json()['date']['far']
-    except Exception as e:
-        logger.error(f"Failed to get Shamsi date: {e}")
-        return "N/A"
-
-def get_current_prices(captions: list[str]) -> dict[str, tuple[float, int]]:
-    """Fetches current values and timestamps for specific captions from DB."""
-    if not captions:
-        return {}
-
-    placeholders = ','.join('?' * len(captions))
-    query = f"SELECT caption, value, timestamp FROM prices WHERE caption IN ({placeholders})"
-    results = db_query(query, tuple(captions))
-
-    # Create a dictionary for easy lookup
-    price_dict = {row[0]: (row[1], row[2]) for row in results} # {caption: (value, timestamp)}
-    return price_dict
+    """Gets the current Shamsi date (cached per calendar day)."""
+    today = datetime.now().date()
+    if _SHAMSI_CACHE["day"] != today:
+        try:
+            # Use jdatetime library
+            now_shamsi = jdatetime.datetime.fromgregorian(datetime=datetime.now())
+            # Format: YYYY/MM/DD (adjust as needed)
+            _SHAMSI_CACHE["s"] = now_shamsi.strftime("%Y/%m/%d")
+            _SHAMSI_CACHE["day"] = today
+            # Alternative: Call the keybit API if preferred
+            # response = requests.get("https://api.keybit.ir/time/")
+            # response.raise_for_status()
+            # return response.json()['date']['far']
+        except Exception as e:
+            logger.error(f"Failed to get Shamsi date: {e}")
+            return "N/A"
+    return _SHAMSI_CACHE["s"]
 
-async def send_updates_job(context: ContextTypes.DEFAULT_TYPE):
-    """Job function run by JobQueue to send updates."""
-    logger.info("Running scheduled update job...")
+def get_current_prices() -> dict[str, tuple[float, int]]:
+    """Fetches the whole prices table as {caption: (value, timestamp)}.
 
-    # 1. Get all users who have subscriptions
-    query_users = """
-    SELECT DISTINCT u.chat_id, u.last_message_id
-    FROM users u JOIN subscriptions s ON u.chat_id = s.chat_id
+    The table is tiny (one row per item), so one index-ordered scan per
+    broadcast tick is cheaper than filtering per user.
     """
-    users_to_update = db_query(query_users)
+    results = db_query("SELECT caption, value, timestamp FROM prices")
+    return {row[0]: (row[1], row[2]) for row in results}
 
-    if not users_to_update:
-        logger.info("No users with active subscriptions found.")
-        return
+SEND_CONCURRENCY = 25 # Max in-flight Telegram requests during a broadcast
 
-    shamsi_date = get_shamsi_date()
-    time_str = datetime.now().strftime("%H:%M:%S")
-    message_footer = f"\n\n📡 <i>قیمت‌ها بروز هستند.</i>" # Simplified footer
-
-    for chat_id, last_message_id in users_to_update:
-        # 2. Get user's specific subscriptions
-        user_subscriptions = get_user_subscriptions(chat_id)
-        if not user_subscriptions:
-            continue # Should not happen based on query_users, but check anyway
-
-        # 3. Get current prices for subscribed items
-        current_prices = get_current_prices(user_subscriptions)
-        if not current_prices:
-            logger.warning(f"No current prices found for subscriptions of user {chat_id}. Skipping.")
-            continue # Skip user if their items aren't in the prices table
-
-        # 4. Format message (No price comparison emoji here, just latest)
-        message_body = ""
-        has_data = False
-        # Sort by caption maybe?
-        for caption in sorted(user_subscriptions):
-            if caption in current_prices:
-                value, timestamp = current_prices[caption]
-                # You could add logic here to compare with a 'previous_prices' cache
-                # stored perhaps in context.bot_data if you want the 📈/📉 emojis back.
-                # For simplicity now, just show the current value.
-                message_body += f"🔹 <b>{caption}:</b> {value:,.0f} تومان\n\n" # Format as integer تومان
-                has_data = True
-
-        if not has_data:
-            logger.info(f"No relevant price data found for user {chat_id} this cycle.")
-            continue
+# Prebuilt line template for the broadcast body; format as integer تومان
+_PRICE_LINE = "🔹 <b>{}:</b> {:,.0f} تومان\n\n"
 
-        # 5. Construct and send/edit message
-        message_header = f"📢 <b>آخرین قیمت‌ها (موارد انتخابی شما)</b>\n🗓 تاریخ: <b>{shamsi_date}</b>\n⏰ ساعت: <b>{time_str}\n\n"
-        full_message = message_header + message_body.strip() + message_footer
+def _delete_blocked_users(blocked: set[int]):
+    """Removes users who blocked the bot; CASCADE drops their subscriptions."""
+    try:
+        with _DB_LOCK:
+            _CONN.execute("BEGIN IMMEDIATE")
+            _CONN.executemany("DELETE FROM users WHERE chat_id = ?",
+                              [(chat_id,) for chat_id in blocked])
+            _CONN.commit()
+        logger.info(f"Removed {len(blocked)} blocked users and their subscriptions.")
+    except sqlite3.Error as e:
+        logger.error(f"Database error removing blocked users: {e}")
+        try:
+            _CONN.execute("ROLLBACK")
+        except sqlite3.Error:
+            pass
 
-        new_message_id = None
+def _apply_message_id_updates(pending_updates: list[tuple[int, int]]):
+    """Writes collected (last_message_id, chat_id) pairs in one transaction."""
+    try:
+        with _DB_LOCK:
+            _CONN.execute("BEGIN IMMEDIATE")
+            _CONN.executemany(
+                "UPDATE users SET last_message_id = ? WHERE chat_id = ?",
+                pending_updates)
+            _CONN.commit()
+        logger.info(f"Updated last_message_id for {len(pending_updates)} users.")
+    except sqlite3.Error as e:
+        logger.error(f"Database error bulk-updating last_message_id: {e}")
+        try:
+            _CONN.execute("ROLLBACK")
+        except sqlite3.Error:
+            pass
+
+async def _push_update(context: ContextTypes.DEFAULT_TYPE, chat_id: int,
+                       last_message_id: int, full_message: str,
+                       semaphore: asyncio.Semaphore, blocked: set[int]) -> tuple[bool, int | None]:
+    """Sends or edits one user's update message.
+
+    Returns (pushed, new_message_id): pushed is True once the user's message
+    reflects full_message, new_message_id is set if a new message was sent.
+    Users who blocked the bot are recorded in `blocked` for cleanup.
+    """
+    async with semaphore:
         try:
             if last_message_id:
                 await context.bot.edit_message_text(
@@ -356,6 +453,7 @@ async def send_updates_job(context: ContextTypes.DEFAULT_TYPE):
                     parse_mode=ParseMode.HTML
                 )
                 logger.info(f"Edited message {last_message_id} for user {chat_id}")
+                return True, None
             else:
                 # Send new message if no previous ID
                 sent_msg = await context.bot.send_message(
@@ -363,29 +461,141 @@ async def send_updates_job(context: ContextTypes.DEFAULT_TYPE):
                     text=full_message,
                     parse_mode=ParseMode.HTML
                 )
-                new_message_id = sent_msg.message_id
-                logger.info(f"Sent new message {new_message_id} to user {chat_id}")
+                logger.info(f"Sent new message {sent_msg.message_id} to user {chat_id}")
+                return True, sent_msg.message_id
 
         except BadRequest as e:
             if "Message to edit not found" in str(e) or "message can't be edited" in str(e) or "Message is not modified" in str(e):
                  logger.warning(f"Editing failed for user {chat_id}, msg_id {last_message_id}. Sending new message. Error: {e}")
                  try:
                      sent_msg = await context.bot.send_message(chat_id=chat_id, text=full_message, parse_mode=ParseMode.HTML)
-                     new_message_id = sent_msg.message_id
-                     logger.info(f"Sent new message {new_message_id} after edit failed for user {chat_id}")
+                     logger.info(f"Sent new message {sent_msg.message_id} after edit failed for user {chat_id}")
+                     return True, sent_msg.message_id
                  except Exception as send_e:
                      logger.error(f"Failed to send new message to user {chat_id} after edit failure: {send_e}")
             else:
                  logger.error(f"Unhandled BadRequest sending/editing update for {chat_id}: {e}")
         except Forbidden as e:
-            logger.warning(f"Bot blocked or kicked by user {chat_id}: {e}. Consider removing user/subs.")
-            # Add logic here to potentially remove the user's subscriptions if blocked
+            logger.warning(f"Bot blocked or kicked by user {chat_id}: {e}. Removing user and subscriptions.")
+            blocked.add(chat_id)
         except Exception as e:
              logger.error(f"Unexpected error sending update to user {chat_id}: {e}")
 
-        # 6. Update last_message_id in DB if a new message was sent
+    return False, None
+
+async def send_updates_job(context: ContextTypes.DEFAULT_TYPE):
+    """Job function run by JobQueue to send updates."""
+    logger.info("Running scheduled update job...")
+
+    # 1. Fetch the whole prices table once for the tick. Joining prices into
+    # the per-subscription query duplicated each price into every subscriber
+    # row; looking values up in this dict keeps the scan to O(items).
+    all_prices = await asyncio.to_thread(get_current_prices)
+    if not all_prices:
+        logger.warning("No prices in the database. Miner might not be running.")
+        return
+
+    # Bail out of the whole cycle if the miner hasn't written since the last
+    # broadcast - every edit would be a no-op "Message is not modified".
+    max_ts = max(ts for _, ts in all_prices.values())
+    if context.bot_data.get('last_broadcast_ts') == max_ts:
+        logger.info("No price updates since last broadcast. Skipping cycle.")
+        return
+    context.bot_data['last_broadcast_ts'] = max_ts
+
+    # 2. One JOIN for all users and their subscriptions. Fetching this per
+    # user costs 2 queries x N users per minute; here the whole broadcast is
+    # a single B-tree walk, grouped by chat_id in Python.
+    query_updates = """
+    SELECT u.chat_id, u.last_message_id, s.caption
+    FROM users u
+    JOIN subscriptions s ON u.chat_id = s.chat_id
+    ORDER BY u.chat_id, s.caption
+    """
+    update_rows = await adb_query(query_updates)
+
+    if not update_rows:
+        logger.info("No users with active subscriptions found.")
+        return
+
+    # Per-user (caption, value) tuples last sent, to skip users whose
+    # subscribed prices didn't move even though the miner ran. Plain tuples
+    # rather than hash(): bot_data is pickled by the persistence layer, and
+    # builtin string hashes are salted per process, so hashes would be
+    # garbage after every restart.
+    last_sent = context.bot_data.setdefault('last_sent', {})
+
+    shamsi_date = get_shamsi_date()
+    time_str = datetime.now().strftime("%H:%M:%S")
+    message_footer = f"\n\n📡 <i>قیمت‌ها بروز هستند.</i>" # Simplified footer
+
+    # 3. Group the sorted rows per user (ORDER BY chat_id makes groupby safe,
+    # and ORDER BY caption keeps the per-user item order stable), building
+    # one push task per user. The tasks run concurrently below so the job
+    # overlaps Telegram round-trips instead of paying N x RTT serially.
+    semaphore = asyncio.Semaphore(SEND_CONCURRENCY)
+    blocked: set[int] = set()
+    tasks = []
+    task_chat_ids = []
+    task_body_keys = []
+    for (chat_id, last_message_id), user_rows in itertools.groupby(
+            update_rows, key=lambda row: (row[0], row[1])):
+        subscribed = [row[2] for row in user_rows if row[2] in all_prices]
+        if not subscribed:
+            logger.info(f"No relevant price data found for user {chat_id} this cycle.")
+            continue
+
+        # Skip users whose subscribed values are unchanged since their last
+        # message (only if they already have one to keep showing). The key
+        # is recorded after the push succeeds, so failed users retry next tick.
+        body_key = tuple((caption, all_prices[caption][0]) for caption in subscribed)
+        if last_message_id and last_sent.get(chat_id) == body_key:
+            continue
+
+        # 4. Format message (No price comparison emoji here, just latest).
+        # The JOIN already sorted rows by caption; build the parts in a list
+        # and join once instead of growing a string per line.
+        message_body = "".join(
+            _PRICE_LINE.format(caption, all_prices[caption][0])
+            for caption in subscribed)
+
+        # 5. Construct the message and queue the send/edit
+        message_header = f"📢 <b>آخرین قیمت‌ها (موارد انتخابی شما)</b>\n🗓 تاریخ: <b>{shamsi_date}</b>\n⏰ ساعت: <b>{time_str}\n\n"
+        full_message = message_header + message_body.strip() + message_footer
+
+        tasks.append(_push_update(context, chat_id, last_message_id, full_message, semaphore, blocked))
+        task_chat_ids.append(chat_id)
+        task_body_keys.append(body_key)
+
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    # 6. For users whose push succeeded, remember what they're now showing
+    # and collect new message IDs: one transaction (one fsync) for the whole
+    # broadcast instead of one per user. Failed pushes keep their old entry
+    # so the next tick retries them.
+    pending_updates = []
+    for chat_id, body_key, result in zip(task_chat_ids, task_body_keys, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Push task for user {chat_id} failed: {result}")
+            continue
+        pushed, new_message_id = result
+        if not pushed:
+            continue
+        last_sent[chat_id] = body_key
         if new_message_id:
-             db_query("UPDATE users SET last_message_id = ? WHERE chat_id = ?", (new_message_id, chat_id), commit=True)
+            pending_updates.append((new_message_id, chat_id))
+
+    if pending_updates:
+        await asyncio.to_thread(_apply_message_id_updates, pending_updates)
+
+    # 7. Drop users who blocked the bot so the next cycle skips them; the
+    # ON DELETE CASCADE on subscriptions removes their rows too. Their
+    # change-tracking entries go with them so bot_data doesn't accumulate
+    # entries for deleted users.
+    if blocked:
+        await asyncio.to_thread(_delete_blocked_users, blocked)
+        for chat_id in blocked:
+            last_sent.pop(chat_id, None)
 
 
 # --- Main Application Setup ---
@@ -393,15 +603,13 @@ if __name__ == "__main__":
     logger.info("Starting Telegram Bot App...")
     setup_database()
 
-    # Optional: Setup persistence for user_data (to remember selections across restarts)
-    # You might need to install `python-telegram-bot[persistence]`
-    # persistence = DictPersistence() # Simple in-memory dict persistence
-    # Consider PicklePersistence for saving to file:
-    # from telegram.ext import PicklePersistence
-    # persistence = PicklePersistence(filepath='bot_persistence.pickle')
+    # Persist user_data (temp_selection) across restarts, so button presses
+    # after a restart don't each fall back to rebuilding the selection from
+    # the database - that path is now cold-start only.
+    persistence = PicklePersistence(filepath='bot_persistence.pickle')
 
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(TELEGRAM_TOKEN).build() # Add .persistence(persistence) if using it
+    application = Application.builder().token(TELEGRAM_TOKEN).persistence(persistence).build()
 
     # Add command handlers
     application.add_handler(CommandHandler("start", start))
@@ -417,4 +625,5 @@ if __name__ == "__main__":
     # Run the bot until the user presses Ctrl-C
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
-    logger.info("Bot stopped.")
\ No newline at end of file
+    logger.info("Bot stopped.")
+    _log_listener.stop() # Flush queued records before exiting
\ No newline at end of file
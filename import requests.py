@@ -1,10 +1,11 @@
-import requests
-import schedule
-import time
+import asyncio
+import aiohttp
 import sqlite3
 import logging
 import os
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
 
 # --- Configuration ---
 API_URL = "http://et.tala.ir/webservice/rafshan/6397db883000095bb8ed65398865c994"
@@ -13,45 +14,73 @@ LOG_FILE = "price_miner.log"
 FETCH_INTERVAL_MINUTES = 1
 
 # --- Logging Setup ---
+# Records go onto an in-process queue and a background QueueListener drains
+# them to the file and console, keeping file I/O off the fetch loop.
+_log_queue = Queue(-1)
+_log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+_file_handler = logging.FileHandler(LOG_FILE)
+_file_handler.setFormatter(_log_formatter)
+_stream_handler = logging.StreamHandler() # Also print to console
+_stream_handler.setFormatter(_log_formatter)
+_log_listener = QueueListener(_log_queue, _file_handler, _stream_handler)
+_log_listener.start()
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler() # Also print to console
-    ])
+    # Plain passthrough: QueueHandler.prepare() bakes this format into the
+    # record, so the real formatting must happen only in the listener's
+    # handlers or every line gets formatted twice.
+    format='%(message)s',
+    handlers=[QueueHandler(_log_queue)])
 
 # --- Database Setup ---
+# Shared connection, opened once in setup_database() and reused by every
+# store_prices() call. Reconnecting each minute drops SQLite's page cache
+# and re-pays file open/close for no benefit.
+_CONN = None
+
 def setup_database():
-    """Creates the database and prices table if they don't exist."""
+    """Creates the database and prices table, and opens the shared connection."""
+    global _CONN
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            # Prices table: Stores the latest processed price for each item
-            cursor.execute("""
-            CREATE TABLE IF NOT EXISTS prices (
-                caption TEXT PRIMARY KEY,
-                value REAL NOT NULL,
-                timestamp INTEGER NOT NULL
-            )
-            """)
-            conn.commit()
-            logging.info("Database setup complete.")
+        conn = sqlite3.connect(DB_FILE, isolation_level=None)
+        cursor = conn.cursor()
+        # WAL so the telegram bot can read while we write.
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA cache_size=-64000")
+        # Prices table: Stores the latest processed price for each item
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS prices (
+            caption TEXT PRIMARY KEY,
+            value REAL NOT NULL,
+            timestamp INTEGER NOT NULL
+        )
+        """)
+        _CONN = conn
+        logging.info("Database setup complete.")
     except sqlite3.Error as e:
         logging.error(f"Database setup error: {e}")
         raise # Reraise to stop the script if DB setup fails
 
 # --- Price Fetching and Processing ---
-def fetch_prices():
-    """Fetches raw price data from the API."""
+async def fetch_prices(session: aiohttp.ClientSession):
+    """Fetches raw price data from the API using the shared session."""
     try:
-        response = requests.get(API_URL, timeout=10) # Add timeout
-        response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
-        return response.json()
-    except requests.exceptions.RequestException as e:
+        async with session.get(API_URL, timeout=aiohttp.ClientTimeout(total=10)) as response:
+            response.raise_for_status() # Raise for bad responses (4xx or 5xx)
+            return await response.json(content_type=None)
+    # ValueError covers json.JSONDecodeError: a 200 response with a non-JSON
+    # body (maintenance page etc.) must not kill the fetch loop.
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
         logging.error(f"Error fetching API data: {e}")
         return None
 
+# Multiplier per caption, classified once. The item set is small and fixed,
+# so after the first tick every caption resolves with one dict lookup
+# instead of re-scanning the string for "انس" every minute.
+_MUL_CACHE = {}
+
 def process_prices(api_data):
     """Processes raw data, applies multipliers, and returns final values."""
     if not api_data:
@@ -68,13 +97,13 @@ def process_prices(api_data):
                     logging.warning(f"Skipping item with invalid caption: {item_data}")
                     continue
 
-                # Apply conditional multipliers
-                if "انس" in caption:  # Check for "ounce"
-                    processed_value = raw_value * 10
-                else:
-                    processed_value = raw_value * 0.1
+                # Apply conditional multipliers (cached per caption)
+                multiplier = _MUL_CACHE.get(caption)
+                if multiplier is None:
+                    multiplier = 10 if "انس" in caption else 0.1  # "انس" = ounce
+                    _MUL_CACHE[caption] = multiplier
 
-                processed[caption] = processed_value
+                processed[caption] = raw_value * multiplier
             else:
                  logging.warning(f"Skipping invalid item data: Key='{key}', Data='{item_data}'")
 
@@ -92,48 +121,65 @@ def store_prices(processed_prices):
         return
 
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            timestamp = int(datetime.now().timestamp()) # Use Unix timestamp
-
-            for caption, value in processed_prices.items():
-                # Use INSERT OR REPLACE to add new or update existing prices
-                cursor.execute("""
-                INSERT OR REPLACE INTO prices (caption, value, timestamp)
-                VALUES (?, ?, ?)
-                """, (caption, value, timestamp))
-
-            conn.commit()
-            logging.info(f"Stored/Updated {len(processed_prices)} prices in the database.")
+        timestamp = int(datetime.now().timestamp()) # Use Unix timestamp
+        rows = [(caption, value, timestamp) for caption, value in processed_prices.items()]
+
+        # One explicit transaction: a single fsync and one prepared-statement
+        # bind cycle for the whole batch instead of one per row. BEGIN
+        # IMMEDIATE takes the write lock up front rather than upgrading later.
+        _CONN.execute("BEGIN IMMEDIATE")
+        # Native UPSERT updates existing rows in place. INSERT OR REPLACE
+        # deletes and reinserts, which churns the rowid and would trigger
+        # cascade deletes if foreign keys ever reference prices.
+        _CONN.executemany("""
+        INSERT INTO prices (caption, value, timestamp)
+        VALUES (?, ?, ?)
+        ON CONFLICT(caption) DO UPDATE SET
+            value = excluded.value,
+            timestamp = excluded.timestamp
+        """, rows)
+        _CONN.commit()
+
+        logging.info(f"Stored/Updated {len(rows)} prices in the database.")
 
     except sqlite3.Error as e:
         logging.error(f"Database error during price storage: {e}")
+        try:
+            _CONN.execute("ROLLBACK")
+        except sqlite3.Error:
+            pass
     except Exception as e:
         logging.error(f"An unexpected error occurred during price storage: {e}")
 
 
 # --- Main Job ---
-def price_update_job():
-    """The main job to be scheduled."""
+async def price_update_job(session: aiohttp.ClientSession):
+    """Fetches, processes and stores one round of prices."""
     logging.info("Running price update job...")
-    raw_data = fetch_prices()
+    raw_data = await fetch_prices(session)
     if raw_data:
         processed_data = process_prices(raw_data)
         store_prices(processed_data)
     logging.info("Price update job finished.")
 
-# --- Scheduler ---
-if __name__ == "__main__":
-    logging.info("Starting Price Miner App...")
-    setup_database()
-
-    # Schedule the job
-    schedule.every(FETCH_INTERVAL_MINUTES).minutes.do(price_update_job)
+async def main():
+    """Runs the fetch loop on a single keep-alive session.
 
-    # Run the job immediately first time
-    price_update_job()
+    The session persists across iterations, so the TCP/TLS handshake to the
+    API is paid once instead of every minute, and asyncio.sleep replaces the
+    old schedule + time.sleep(1) polling loop (60 wake-ups per minute).
+    """
+    setup_database()
+    async with aiohttp.ClientSession() as session:
+        while True:
+            await price_update_job(session)
+            await asyncio.sleep(FETCH_INTERVAL_MINUTES * 60)
 
-    # Keep the script running to execute scheduled jobs
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
\ No newline at end of file
+if __name__ == "__main__":
+    logging.info("Starting Price Miner App...")
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logging.info("Price Miner stopped.")
+    finally:
+        _log_listener.stop() # Flush queued records before exiting
\ No newline at end of file
@@ -56,6 +56,13 @@ CREATE_SUBSCRIPTION_INDEX = """
 CREATE INDEX IF NOT EXISTS idx_sub_chat_id ON subscriptions (chat_id);
 """
 
+# Index for joining subscriptions to prices by caption. The composite
+# primary key (chat_id, caption) cannot seek by caption alone, so without
+# this the broadcast JOIN full-scans the subscriptions table.
+CREATE_SUBSCRIPTION_CAPTION_INDEX = """
+CREATE INDEX IF NOT EXISTS idx_sub_caption ON subscriptions (caption);
+"""
+
 def create_database_schema():
     """
     Connects to the SQLite database (creating it if it doesn't exist)
@@ -86,6 +93,14 @@ def create_database_schema():
         logging.info("Creating index on 'subscriptions.chat_id' (if not exists)...")
         cursor.execute(CREATE_SUBSCRIPTION_INDEX)
 
+        logging.info("Creating index on 'subscriptions.caption' (if not exists)...")
+        cursor.execute(CREATE_SUBSCRIPTION_CAPTION_INDEX)
+
+        # Gather table statistics so the query planner picks sensible join
+        # orders for the broadcast JOIN.
+        logging.info("Running ANALYZE to refresh query planner statistics...")
+        cursor.execute("ANALYZE;")
+
         # Commit the changes
         conn.commit()
         logging.info("Database schema created/verified successfully.")